@@ -1,11 +1,128 @@
-import numpy as np
-import requests
-import pandas as pd
+import math
+import os
+import socket
+import threading
+import time
+from functools import lru_cache, wraps
+
+try:
+    from numba import guvectorize, njit
+except ImportError:  # numba is optional, the kernels then run as plain Python
+    guvectorize = None
+
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 """
 A module to compute Modified Berggren Frost Depth.
 """
 
+# seconds a fetched SNAP Data API payload is reused before it is requested again
+API_CACHE_TTL = 60 * 60 * 24
+# (connect, read) socket timeouts in seconds, the overall deadline for a request and the largest decoded body we will parse
+API_TIMEOUT = (3.05, 10)
+API_DEADLINE = 20
+MAX_RESPONSE_BYTES = 2_000_000
+
+
+@lru_cache(maxsize=None)
+def _get_session():
+    """Build the shared session that keeps connections to the SNAP Data API alive across Streamlit reruns.
+
+    requests is imported here rather than at module level so importing modberg stays cheap until the API is first queried.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    # retry only failed connections (at most 3 x 3.05 s plus 0.6 s of backoff, about 10 s) and never reads; _get_json
+    # gives up on the whole request, retries included, after API_DEADLINE
+    adapter = HTTPAdapter(
+        pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, read=0, backoff_factor=0.3))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _download(api_url, responses):
+    """Stream a SNAP Data API response body, aborting once its decoded size passes MAX_RESPONSE_BYTES.
+
+    The open response is appended to responses so _get_json can shut its socket down if the deadline passes.
+    """
+    too_large = f"SNAP Data API response exceeds {MAX_RESPONSE_BYTES} bytes: {api_url}"
+    with _get_session().get(api_url, timeout=API_TIMEOUT, stream=True) as resp:
+        responses.append(resp)
+        resp.raise_for_status()
+        content_length = resp.headers.get("Content-Length", "")
+        if content_length.isdigit() and int(content_length) > MAX_RESPONSE_BYTES:
+            raise ValueError(too_large)
+        raw = bytearray()
+        # iter_content yields decoded bytes, so the cap also holds for compressed bodies
+        for chunk in resp.iter_content(chunk_size=65536):
+            raw += chunk
+            if len(raw) > MAX_RESPONSE_BYTES:
+                raise ValueError(too_large)
+    return raw
+
+
+def _abort(resp):
+    """Shut down the socket under a streaming response so a read blocked on it returns at once."""
+    try:
+        # a duplicate descriptor is enough, shutdown acts on the socket rather than the descriptor
+        sock = socket.socket(fileno=os.dup(resp.raw.fileno()))
+    except (OSError, ValueError):  # the response has already been closed
+        return
+    with sock:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _get_json(api_url):
+    """GET a SNAP Data API endpoint and parse the JSON body.
+
+    The download runs in a worker thread that is abandoned after API_DEADLINE, so the call returns within API_DEADLINE seconds however slowly the endpoint sends data. The body is streamed and capped at MAX_RESPONSE_BYTES once decoded.
+
+    Args:
+        api_url: endpoint to query
+    Returns:
+        the decoded JSON object (a dict)
+    Raises:
+        requests.HTTPError: the endpoint returned an error status
+        requests.Timeout: connecting or waiting for the response headers timed out, or the whole response was not received within API_DEADLINE
+        requests.ConnectionError: the connection failed, or the body stalled for longer than the read timeout
+        ValueError: the body exceeds MAX_RESPONSE_BYTES, is not valid JSON or is not a JSON object
+    """
+    import orjson
+    import requests
+
+    responses = []
+    outcome = {}
+
+    def download():
+        try:
+            outcome["raw"] = _download(api_url, responses)
+        except BaseException as e:
+            outcome["error"] = e
+
+    # a daemon thread, so a response still trickling in when we give up cannot hold the app or block shutdown
+    worker = threading.Thread(target=download, name="snap-api-download", daemon=True)
+    worker.start()
+    worker.join(API_DEADLINE)
+    if worker.is_alive():
+        # free the worker too once the response is open; before that it ends with its own socket timeouts
+        for resp in responses:
+            _abort(resp)
+        raise requests.Timeout(f"SNAP Data API response took longer than {API_DEADLINE} s: {api_url}")
+    if "error" in outcome:
+        raise outcome["error"]
+    payload = orjson.loads(outcome["raw"])
+    if not isinstance(payload, dict):
+        raise ValueError(f"Unexpected SNAP Data API payload: {api_url}")
+    return payload
+
 
 def compute_volumetric_latent_heat_of_fusion(dry_ro, wc_pct):
     """Compute the amount of heat required to melt all the ice or freeze the pore water) in a unit volume of soil.
@@ -15,44 +132,41 @@ def compute_volumetric_latent_heat_of_fusion(dry_ro, wc_pct):
     Returns:
         L: volumetric latent heat of fusion (BTUs per cubic foot)
     """
-    L = 144 * dry_ro * (wc_pct / 100)
-    return round(L, 2)
+    L = 144 * dry_ro * (wc_pct * 0.01)
+    return L
 
 
-def compute_frozen_volumetric_specific_heat(dry_ro, wc_pct):
-    """Compute quantity of heat required to change the temperature of a frozen unit volume of soil by 1°F. The specific heat of soil solids is 0.17 BTU/lb • °F for most soils.
+# multiplier on the water fraction for the specific heat of water/ice, by soil state; anything else is the average
+_FROZEN_MOD = {"frozen": 0.5, "unfrozen": 1.0}
+
+
+def compute_volumetric_specific_heat(dry_ro, wc_pct, is_frozen=None):
+    """Compute quantity of heat required to change the temperature of a unit volume of soil by 1°F. The specific heat of soil solids is 0.17 BTU/lb • °F for most soils.
     Args:
         dry_ro: soil dry density (lbs per cubic foot)
         wc_pct: percent water content (percent)
+        is_frozen: optional soil state, "frozen" or "unfrozen" (case-insensitive); the average of the two when omitted
     Returns:
         c: volumetric specific heat (BTUs per cubic foot) • °F
     """
-    c = dry_ro * (0.17 + (0.5 * (wc_pct / 100)))
-    return round(c, 2)
+    frozen_mod = _FROZEN_MOD.get(is_frozen.lower() if is_frozen else "", 0.75)
+    c = dry_ro * (0.17 + (frozen_mod * (wc_pct * 0.01)))
+    return c
+
+
+def compute_frozen_volumetric_specific_heat(dry_ro, wc_pct):
+    """Compute the volumetric specific heat of a frozen unit volume of soil (see compute_volumetric_specific_heat)."""
+    return compute_volumetric_specific_heat(dry_ro, wc_pct, "frozen")
 
 
 def compute_unfrozen_volumetric_specific_heat(dry_ro, wc_pct):
-    """Compute quantity of heat required to change the temperature of an unfrozen unit volume of soil by 1°F. The specific heat of soil solids is 0.17 BTU/lb • °F for most soils.
-    Args:
-        dry_ro: soil dry density (lbs per cubic foot)
-        wc_pct: percent water content (percent)
-    Returns:
-        c: volumetric specific heat (BTUs per cubic foot) • °F
-    """
-    c = dry_ro * (0.17 + (1.0 * (wc_pct / 100)))
-    return round(c, 2)
+    """Compute the volumetric specific heat of an unfrozen unit volume of soil (see compute_volumetric_specific_heat)."""
+    return compute_volumetric_specific_heat(dry_ro, wc_pct, "unfrozen")
 
 
 def compute_avg_volumetric_specific_heat(dry_ro, wc_pct):
-    """Compute quantity of heat required to change the temperature of an average unit volume of soil by 1°F. The specific heat of soil solids is 0.17 BTU/lb • °F for most soils.
-    Args:
-        dry_ro: soil dry density (lbs per cubic foot)
-        wc_pct: percent water content (percent)
-    Returns:
-        c: volumetric specific heat (BTUs per cubic foot) • °F
-    """
-    c = dry_ro * (0.17 + (0.75 * (wc_pct / 100)))
-    return round(c, 2)
+    """Compute the volumetric specific heat of an average unit volume of soil (see compute_volumetric_specific_heat)."""
+    return compute_volumetric_specific_heat(dry_ro, wc_pct)
 
 
 def compute_seasonal_v_s(nFI, d):
@@ -70,24 +184,79 @@ def compute_seasonal_v_s(nFI, d):
     return v_s
 
 
-def get_projected_mat_from_api(lat, lon, model, scenario, year_start, year_end):
-    """Query the SNAP Data API for mean annual temperature."""
+def _ttl_cache(ttl, maxsize):
+    """Memoize a function of hashable positional arguments.
 
+    Entries expire ttl seconds after they are stored and the oldest entries are evicted beyond maxsize, so payloads are refreshed and memory stays bounded for the life of the process.
+    """
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(args)
+            if hit is not None and now - hit[0] < ttl:
+                return hit[1]
+            value = func(*args)
+            with lock:
+                cache.pop(args, None)
+                cache[args] = (now, value)
+                while len(cache) > maxsize:
+                    del cache[next(iter(cache))]
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+@_ttl_cache(API_CACHE_TTL, maxsize=16)
+def _fetch_temperature(lat, lon):
+    """Fetch (and memoize) the SNAP Data API temperature payload for a point."""
     api_url = f"https://earthmaps.io/mmm/temperature/all/{lat}/{lon}"
-    resp = requests.get(api_url).json()[model][scenario]
-    df = pd.json_normalize(resp, sep="_").T
-    years = [int(j.split('_')[0]) for j in df.index.values]
-    df["year"] = years
-    df.set_index("year", inplace=True)
-    mean_temp_degC = df.loc[year_start:year_end].mean()
+    return _get_json(api_url)
+
+
+@_ttl_cache(API_CACHE_TTL, maxsize=16)
+def _fetch_design_freezing_index(lat, lon):
+    """Fetch (and memoize) the SNAP Data API design freezing index payload for a point."""
+    api_url = f"https://earthmaps.io/design_index/freezing/all/point/{lat}/{lon}"
+    return _get_json(api_url)
+
+
+def _walk(obj, prefix=""):
+    """Yield (key, value) pairs for the leaves of a nested dict, joining nested keys with underscores."""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _walk(v, f"{prefix}{k}_")
+    else:
+        yield prefix[:-1], obj
+
+
+def get_projected_mat_from_api(lat, lon, model, scenario, year_start, year_end):
+    """Query the SNAP Data API for mean annual temperature."""
+    resp = _fetch_temperature(round(lat, 4), round(lon, 4))[model][scenario]
+    total, n = 0.0, 0
+    for year, temps in resp.items():
+        if year_start <= int(year) <= year_end:
+            for _, temp_degC in _walk(temps):
+                total += temp_degC
+                n += 1
+    if not n:
+        raise ValueError(
+            f"No {model} {scenario} temperatures between {year_start} and {year_end} at ({lat}, {lon})")
+    mean_temp_degC = total / n
     mat_degF = (mean_temp_degC * 1.8) + 32
-    return float(round(mat_degF, 1))
+    return mat_degF
 
 
 def get_projected_design_fi_from_api(lat, lon, model, era):
     """Query the SNAP Data API for design freezing index."""
-    api_url = f"https://earthmaps.io/design_index/freezing/all/point/{lat}/{lon}"
-    design_freezing_index_degF = requests.get(api_url).json()[model][era]["di"]
+    design_freezing_index_degF = _fetch_design_freezing_index(
+        round(lat, 4), round(lon, 4))[model][era]["di"]
     return design_freezing_index_degF
 
 
@@ -131,7 +300,7 @@ def compute_thermal_ratio(v_o, v_s):
         thermal_ratio: dimensionless
     """
     thermal_ratio = v_o / v_s
-    return round(thermal_ratio, 3)
+    return thermal_ratio
 
 
 def compute_fusion_parameter(v_s, c, L):
@@ -145,7 +314,7 @@ def compute_fusion_parameter(v_s, c, L):
         mu: (dimensionless)
     """
     mu = v_s * (c / L)
-    return round(mu, 3)
+    return mu
 
 
 def compute_coeff(mu, thermal_ratio):
@@ -153,11 +322,11 @@ def compute_coeff(mu, thermal_ratio):
 
     Citation: H. P. Aldrich and H. M. Paynter, “Analytical Studies of Freezing and Thawing of Soils,” Arctic Construction and Frost Effects Laboratory, Corps of Engineers, U.S. Army, Boston, MA, First Interim Technical Report 42, Jun. 1953.
 
-    Other implementations:
-    lc2 = 0.707 / (np.sqrt(1 + (mu * (thermal_ratio + 0.5))))
-    lc_mean = round(np.mean([lc1, lc2]), 2)
+    Other implementations (not computed here):
+    lc2 = 0.707 / (math.sqrt(1 + (mu * (thermal_ratio + 0.5))))
+    lc_mean = (lc + lc2) * 0.5
 
-    These are included because:
+    These are noted because:
     lc may overestimate frost depth - but is suited to high latitudes
     lc2 may underestimate frost depth - but is better for lower latitudes
     lc_mean is a middle ground
@@ -168,8 +337,8 @@ def compute_coeff(mu, thermal_ratio):
     Returns
         lc: the lambda coeffcient value (dimensionless).
     """
-    lc = 1.0 / (np.sqrt(1 + (mu * (thermal_ratio + 0.5))))
-    return round(lc, 2)
+    lc = 1.0 / (math.sqrt(1 + (mu * (thermal_ratio + 0.5))))
+    return lc
 
 
 def compute_depth_of_freezing(coeff, k_avg, nFI, L):
@@ -183,29 +352,98 @@ def compute_depth_of_freezing(coeff, k_avg, nFI, L):
     Returns:
         x: frost depth (feet)
     """
-    x = coeff * np.sqrt((48 * k_avg * nFI) / L)
+    x = coeff * math.sqrt((48 * k_avg * nFI) / L)
     return round(x, 1)
 
 
-def compute_modified_bergrenn(dry_ro, wc_pct, mat, magt, d, nFI, k_avg, lat, lon, model, scenario, year_start, year_end):
-    """
+@njit("float64(float64, float64, float64, float64, float64, float64, float64, float64, float64, float64)",
+      cache=True, fastmath=True)
+def _modberg_kernel(dry_ro, wc_pct, magt, d, nFI, k_avg, frozen_mod, lhof_h2o, c_soil, t_freeze):
+    """Closed form of the Modified Berggren frost depth on plain floats (see compute_modified_bergrenn)."""
+    if nFI <= 0:
+        # no freezing season, so no frost penetration
+        return 0.0
+    w = wc_pct * 0.01
+    L = lhof_h2o * dry_ro * w
+    c = dry_ro * (c_soil + (frozen_mod * w))
+    v_s = nFI / d
+    v_o = abs(magt - t_freeze)
+    # lambda * sqrt(48 * k_avg * nFI / L) with lambda = 1 / sqrt(1 + mu * (thermal_ratio + 0.5))
+    # and mu * (thermal_ratio + 0.5) == (c / L) * (v_o + 0.5 * v_s), so a single division remains
+    return math.sqrt((48 * k_avg * nFI) / (L + c * (v_o + 0.5 * v_s)))
+
+
+def compute_modified_bergrenn(dry_ro, wc_pct, magt, d, nFI, k_avg, *, frozen_mod=0.75, lhof_h2o=144, c_soil=0.17, t_freeze=32):
+    """Compute the Modified Berggren frost depth.
+
+    The helpers above are folded into a single closed form (compiled with numba when it is installed) and intermediate values are not rounded. Round the result for display only.
+
     Args:
     dry_ro: soil dry density (lbs per cubic foot)
     wc_pct: water content (percent)
-    mat: mean annual temperature (°F)
     magt: mean annual GROUND temperature (°F)
     d: length of freezing duration (days)
     nFI: surface freezing index (°F • days)
     k_avg: thermal conductivity of soil, average of frozen and unfrozen (BTU/hr • ft • °F)
+    frozen_mod: optional water fraction multiplier for the volumetric specific heat (0.5 frozen, 1.0 unfrozen, 0.75 average)
+    lhof_h2o: optional latent heat of fusion of water (BTU/lb)
+    c_soil: optional specific heat of the soil solids (BTU/lb • °F)
+    t_freeze: optional freezing point (°F)
+    Returns:
+        x: frost depth (feet); 0 when the surface freezing index is not positive
+    """
+    return _modberg_kernel(
+        float(dry_ro), float(wc_pct), float(magt), float(d), float(nFI), float(k_avg),
+        float(frozen_mod), float(lhof_h2o), float(c_soil), float(t_freeze))
+
+
+def _frost_depth_row(wc_pct, dry_ros, magt, d, nFI, k_avg, frozen_mod, lhof_h2o, c_soil, t_freeze, out):
+    """Fill out with the frost depth for one water content across an array of dry densities."""
+    for j in range(dry_ros.shape[0]):
+        out[j] = _modberg_kernel(
+            dry_ros[j], wc_pct, magt, d, nFI, k_avg, frozen_mod, lhof_h2o, c_soil, t_freeze)
+
+
+@lru_cache(maxsize=None)
+def _frost_depth_gufunc():
+    """Compile _frost_depth_row into a parallel gufunc on first use so importing modberg stays cheap."""
+    # one gufunc call per water content, spread across cores by the parallel target
+    return guvectorize(
+        ["void(float64, float64[:], float64, float64, float64, float64, float64, float64, float64, float64, float64[:])"],
+        "(),(m),(),(),(),(),(),(),(),()->(m)",
+        nopython=True,
+        fastmath=True,
+        target="parallel",
+        cache=True,
+    )(_frost_depth_row)
+
+
+def compute_frost_depth_grid(wc_pcts, dry_ros, magt, d, nFI, k_avg, *, frozen_mod=0.75, lhof_h2o=144, c_soil=0.17, t_freeze=32):
+    """Compute the Modified Berggren frost depth for every combination of water content and dry density.
+
+    Args:
+    wc_pcts: water contents (percent)
+    dry_ros: soil dry densities (lbs per cubic foot)
+    magt: mean annual GROUND temperature (°F)
+    d: length of freezing duration (days)
+    nFI: surface freezing index (°F • days)
+    k_avg: thermal conductivity of soil, average of frozen and unfrozen (BTU/hr • ft • °F)
+    frozen_mod: optional water fraction multiplier for the volumetric specific heat (0.5 frozen, 1.0 unfrozen, 0.75 average)
+    lhof_h2o: optional latent heat of fusion of water (BTU/lb)
+    c_soil: optional specific heat of the soil solids (BTU/lb • °F)
+    t_freeze: optional freezing point (°F)
+    Returns:
+        x: frost depths (feet), an array with one row per water content and one column per dry density
     """
-    mat = get_projected_mat_from_api(
-        lat, lon, model, scenario, year_start, year_end)
-    L = compute_volumetric_latent_heat_of_fusion(dry_ro, wc_pct)
-    c = compute_avg_volumetric_specific_heat(dry_ro, wc_pct)
-    v_s = compute_seasonal_v_s(nFI, d)
-    v_o = compute_v_o(magt)
-    thermal_ratio = compute_thermal_ratio(v_o, v_s)
-    mu = compute_fusion_parameter(v_s, c, L)
-    lambda_coeff = compute_coeff(mu, thermal_ratio)
-    frost_depth = compute_depth_of_freezing(lambda_coeff, k_avg, nFI, L)
-    return frost_depth
+    import numpy as np
+
+    wc = np.asarray(wc_pcts, dtype=np.float64)
+    rho = np.asarray(dry_ros, dtype=np.float64)
+    args = (float(magt), float(d), float(nFI), float(k_avg),
+            float(frozen_mod), float(lhof_h2o), float(c_soil), float(t_freeze))
+    if guvectorize is not None:
+        return _frost_depth_gufunc()(wc, rho, *args)
+    out = np.empty((wc.size, rho.size))
+    for i in range(wc.size):
+        _frost_depth_row(float(wc[i]), rho, *args, out[i])
+    return out